@@ -9,21 +9,34 @@ This script tests:
 4. Response parsing
 
 Usage:
-    python debug_image_test.py
+    python debug_image_test.py           # run test cases concurrently
+    python debug_image_test.py --serial  # run test cases one by one
 
 Environment:
     Set FLOW2API_URL and FLOW2API_API_KEY if needed
+    Set FLOW2API_DEBUG_VERBOSE=1 to print full tracebacks and non-streaming responses
+    Set FLOW2API_ASCII_LOG=1 to use plain ASCII status glyphs
 """
 
 import os
+import re
 import sys
 import json
 import aiohttp
 import asyncio
 import io
+import time
 import traceback
 from datetime import datetime
 
+# orjson is optional; it parses SSE chunks (bytes) several times faster than json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
 # Fix Windows console encoding
 if sys.platform == "win32":
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
@@ -33,6 +46,13 @@ if sys.platform == "win32":
 BASE_URL = os.getenv('FLOW2API_URL', 'http://localhost:18282')
 API_ENDPOINT = f"{BASE_URL}/v1/chat/completions"
 API_KEY = os.getenv('FLOW2API_API_KEY', 'PApiKey1800KOOOO')
+VERBOSE = os.getenv('FLOW2API_DEBUG_VERBOSE') == '1'
+
+# Large SSE frames overflow aiohttp's default 64 KiB read buffer ("Chunk too big")
+READ_BUFSIZE = 4 * 1024 * 1024
+
+# Markdown image pattern, compiled once (negated classes avoid backtracking)
+_IMG_RE = re.compile(r'!\[[^\]]*\]\(([^)]+)\)')
 
 # Test configurations
 TEST_CASES = [
@@ -67,36 +87,81 @@ class Colors:
     ENDC = '\033[0m'
     BOLD = '\033[1m'
 
+# Color codes are wasted bytes when output is redirected to a file or CI log
+if not sys.stdout.isatty():
+    for _name in [k for k in vars(Colors) if not k.startswith('_')]:
+        setattr(Colors, _name, '')
+
+class Icons:
+    """Status glyphs (set FLOW2API_ASCII_LOG=1 for consoles that can't render them)"""
+    INFO = 'ℹ'
+    SUCCESS = '✓'
+    FAIL = '✗'
+    WARNING = '⚠'
+
+if os.getenv('FLOW2API_ASCII_LOG') == '1':
+    Icons.INFO, Icons.SUCCESS, Icons.FAIL, Icons.WARNING = 'i', '+', 'x', '!'
+
+_now = datetime.now
+
+def _timestamp() -> str:
+    return _now().strftime("%H:%M:%S.%f")[:-3]
+
 def log_info(message: str):
     """Log info message with timestamp"""
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"{Colors.OKCYAN}[{timestamp}] ℹ {message}{Colors.ENDC}")
+    sys.stdout.write(f"{Colors.OKCYAN}[{_timestamp()}] {Icons.INFO} {message}{Colors.ENDC}\n")
 
 def log_success(message: str):
     """Log success message"""
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"{Colors.OKGREEN}[{timestamp}] ✓ {message}{Colors.ENDC}")
+    sys.stdout.write(f"{Colors.OKGREEN}[{_timestamp()}] {Icons.SUCCESS} {message}{Colors.ENDC}\n")
 
 def log_error(message: str):
-    """Log error message"""
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"{Colors.FAIL}[{timestamp}] ✗ {message}{Colors.ENDC}")
+    """Log error message (flushed immediately)"""
+    sys.stdout.write(f"{Colors.FAIL}[{_timestamp()}] {Icons.FAIL} {message}{Colors.ENDC}\n")
+    sys.stdout.flush()
 
 def log_warning(message: str):
     """Log warning message"""
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"{Colors.WARNING}[{timestamp}] ⚠ {message}{Colors.ENDC}")
+    sys.stdout.write(f"{Colors.WARNING}[{_timestamp()}] {Icons.WARNING} {message}{Colors.ENDC}\n")
 
 def log_section(message: str):
-    """Log section header"""
-    print(f"\n{Colors.BOLD}{Colors.HEADER}{'='*80}{Colors.ENDC}")
-    print(f"{Colors.BOLD}{Colors.HEADER}{message}{Colors.ENDC}")
-    print(f"{Colors.BOLD}{Colors.HEADER}{'='*80}{Colors.ENDC}\n")
+    """Log section header (flushes pending output)"""
+    rule = f"{Colors.BOLD}{Colors.HEADER}{'='*80}{Colors.ENDC}"
+    sys.stdout.write(f"\n{rule}\n{Colors.BOLD}{Colors.HEADER}{message}{Colors.ENDC}\n{rule}\n\n")
+    sys.stdout.flush()
+
+def format_json(data) -> str:
+    """Pretty-print JSON for debug output"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data, indent=2, ensure_ascii=False)
 
-async def test_image_generation(test_config: dict) -> dict:
+async def iter_sse_lines(content: aiohttp.StreamReader, chunk_size: int = 64 * 1024):
+    """Yield raw SSE lines (without the trailing newline) from a response body
+    
+    Reads the body in large chunks and splits on newlines locally, which is
+    much cheaper than aiohttp's per-line iterator on chatty streams.
+    """
+    buffer = bytearray()
+    async for chunk in content.iter_chunked(chunk_size):
+        buffer += chunk
+        start = 0
+        while (nl := buffer.find(b'\n', start)) != -1:
+            yield bytes(buffer[start:nl])
+            start = nl + 1
+        if start:
+            del buffer[:start]
+    if buffer:
+        yield bytes(buffer)
+
+async def test_image_generation(session: aiohttp.ClientSession, test_config: dict) -> dict:
     """
     Test image generation with detailed debugging
     
+    Args:
+        session: Shared client session (keeps the connection to BASE_URL alive)
+        test_config: One entry of TEST_CASES
+    
     Returns:
         dict with test results including success/failure status and details
     """
@@ -132,96 +197,98 @@ async def test_image_generation(test_config: dict) -> dict:
         "Content-Type": "application/json"
     }
     
-    start_time = asyncio.get_event_loop().time()
+    start_time = time.monotonic()
     
     try:
-        async with aiohttp.ClientSession() as session:
-            log_info("Sending request to API...")
+        log_info("Sending request to API...")
+        
+        async with session.post(API_ENDPOINT, json=payload, headers=headers) as response:
+            result["response_status"] = response.status
             
-            async with session.post(
-                API_ENDPOINT, 
-                json=payload, 
-                headers=headers, 
-                timeout=aiohttp.ClientTimeout(total=300)
-            ) as response:
-                result["response_status"] = response.status
-                
-                if response.status != 200:
-                    error_text = await response.text()
-                    log_error(f"HTTP Error {response.status}")
-                    log_error(f"Response: {error_text}")
-                    result["error"] = f"HTTP {response.status}: {error_text}"
-                    return result
+            if response.status != 200:
+                error_text = await response.text()
+                log_error(f"HTTP Error {response.status}")
+                log_error(f"Response: {error_text}")
+                result["error"] = f"HTTP {response.status}: {error_text}"
+                return result
+            
+            log_success(f"Response status: {response.status}")
+            
+            if stream:
+                log_info("Processing streaming response...")
+                chunk_count = 0
                 
-                log_success(f"Response status: {response.status}")
+                # Bind hot names as locals for the per-chunk loop
+                _append = result["reasoning_messages"].append
+                _loads = json_loads
+                _log = log_info
+                _img_search = _IMG_RE.search
                 
-                if stream:
-                    log_info("Processing streaming response...")
-                    chunk_count = 0
+                async for line in iter_sse_lines(response.content):
+                    # Cheap bytes check first: blank/keepalive/event lines are never decoded
+                    if not line.startswith(b'data: '):
+                        continue
                     
-                    async for line in response.content:
-                        line_str = line.decode('utf-8').strip()
-                        if not line_str or not line_str.startswith('data: '):
+                    data_bytes = line[6:].strip()
+                    if data_bytes == b'[DONE]':
+                        log_info("Stream complete (received [DONE])")
+                        break
+                    
+                    try:
+                        chunk = _loads(data_bytes)
+                        chunk_count += 1
+                        try:
+                            delta = chunk["choices"][0]["delta"]
+                        except (KeyError, IndexError, TypeError):
                             continue
                         
-                        data_str = line_str[6:]
-                        if data_str == '[DONE]':
-                            log_info("Stream complete (received [DONE])")
-                            break
+                        # Process reasoning_content (progress messages)
+                        content = delta.get("reasoning_content")
+                        if content is not None:
+                            _append(content)
+                            _log(f"Progress: {content.strip()}")
                         
-                        try:
-                            chunk = json.loads(data_str)
-                            chunk_count += 1
-                            delta = chunk.get("choices", [{}])[0].get("delta", {})
+                        # Process content (final result)
+                        content_text = delta.get("content")
+                        if content_text is not None:
+                            _log(f"Content: {content_text}")
                             
-                            # Process reasoning_content (progress messages)
-                            if "reasoning_content" in delta:
-                                content = delta['reasoning_content']
-                                result["reasoning_messages"].append(content)
-                                log_info(f"Progress: {content.strip()}")
+                            # Try to extract image URL from markdown
+                            img_match = _img_search(content_text)
+                            if img_match:
+                                image_url = img_match.group(1)
+                                result["image_url"] = image_url
+                                log_success(f"Found image URL: {image_url}")
+                                result["success"] = True
                             
-                            # Process content (final result)
-                            if "content" in delta:
-                                content_text = delta["content"]
-                                log_info(f"Content: {content_text}")
-                                
-                                # Try to extract image URL from markdown
-                                import re
-                                img_match = re.search(r'!\[.*?\]\((.*?)\)', content_text)
-                                if img_match:
-                                    image_url = img_match.group(1)
-                                    result["image_url"] = image_url
-                                    log_success(f"Found image URL: {image_url}")
-                                    result["success"] = True
-                                
-                        except json.JSONDecodeError as e:
-                            log_warning(f"Failed to decode chunk: {e}")
-                            continue
-                    
-                    log_info(f"Total chunks received: {chunk_count}")
-                    
-                    if not result["image_url"]:
-                        log_error("No image URL found in response")
-                        result["error"] = "No image URL found in response"
-                        # Log all reasoning messages for debugging
-                        log_warning("Reasoning messages received:")
-                        for msg in result["reasoning_messages"]:
-                            print(f"  - {msg}")
+                    except json.JSONDecodeError as e:
+                        log_warning(f"Failed to decode chunk: {e}")
+                        continue
                 
-                else:
-                    # Non-streaming response
-                    response_json = await response.json()
-                    log_info(f"Non-streaming response: {json.dumps(response_json, indent=2, ensure_ascii=False)}")
-                    
-                    # Extract content from response
-                    choices = response_json.get("choices", [])
-                    if choices:
-                        message = choices[0].get("message", {})
-                        content = message.get("content", "")
-                        log_info(f"Content: {content}")
+                log_info(f"Total chunks received: {chunk_count}")
                 
-        end_time = asyncio.get_event_loop().time()
-        result["response_time_ms"] = int((end_time - start_time) * 1000)
+                if not result["image_url"]:
+                    log_error("No image URL found in response")
+                    result["error"] = "No image URL found in response"
+                    # Log all reasoning messages for debugging
+                    log_warning("Reasoning messages received:")
+                    for msg in result["reasoning_messages"]:
+                        print(f"  - {msg}")
+            
+            else:
+                # Non-streaming response
+                response_json = await response.json(loads=json_loads)
+                if VERBOSE:
+                    log_info(f"Non-streaming response: {format_json(response_json)}")
+                
+                # Extract content from response
+                choices = response_json.get("choices", [])
+                if choices:
+                    message = choices[0].get("message", {})
+                    content = message.get("content", "")
+                    log_info(f"Content: {content}")
+            
+        result["response_time_ms"] = int((time.monotonic() - start_time) * 1000)
         log_info(f"Total time: {result['response_time_ms']}ms")
         
     except asyncio.TimeoutError:
@@ -229,26 +296,57 @@ async def test_image_generation(test_config: dict) -> dict:
         result["error"] = "Request timeout"
     except Exception as e:
         log_error(f"Exception: {type(e).__name__}: {str(e)}")
-        log_error(f"Traceback:\n{traceback.format_exc()}")
+        if VERBOSE:
+            log_error(f"Traceback:\n{traceback.format_exc()}")
         result["error"] = f"{type(e).__name__}: {str(e)}"
     
     return result
 
-async def run_all_tests():
-    """Run all test cases"""
+async def run_all_tests(serial: bool = False):
+    """Run all test cases
+    
+    Args:
+        serial: Run tests one after another (easier to read logs) instead of concurrently
+    """
     log_section("Starting Debug Image Generation Tests")
     log_info(f"Base URL: {BASE_URL}")
     log_info(f"API Key: {API_KEY[:20]}..." if len(API_KEY) > 20 else API_KEY)
     
     results = []
     
-    for test_config in TEST_CASES:
-        result = await test_image_generation(test_config)
-        results.append(result)
-        
-        # Pause between tests
-        if test_config != TEST_CASES[-1]:
-            await asyncio.sleep(2)
+    # One session for all tests so the TCP/TLS connection is reused
+    connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=600, enable_cleanup_closed=True)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        read_bufsize=READ_BUFSIZE,
+        timeout=aiohttp.ClientTimeout(total=300)
+    ) as session:
+        if serial:
+            for test_config in TEST_CASES:
+                result = await test_image_generation(session, test_config)
+                results.append(result)
+                
+                # Pause between tests
+                if test_config != TEST_CASES[-1]:
+                    await asyncio.sleep(2)
+        else:
+            # Test cases are independent and network-bound, run them concurrently
+            outcomes = await asyncio.gather(
+                *(test_image_generation(session, cfg) for cfg in TEST_CASES),
+                return_exceptions=True
+            )
+            for test_config, outcome in zip(TEST_CASES, outcomes):
+                if isinstance(outcome, BaseException):
+                    outcome = {
+                        "test_name": test_config["name"],
+                        "success": False,
+                        "error": f"{type(outcome).__name__}: {str(outcome)}",
+                        "image_url": None,
+                        "reasoning_messages": [],
+                        "response_status": None,
+                        "response_time_ms": None
+                    }
+                results.append(outcome)
     
     # Summary
     log_section("Test Results Summary")
@@ -261,7 +359,7 @@ async def run_all_tests():
     print(f"{Colors.FAIL}Failed: {failed}{Colors.ENDC}\n")
     
     for result in results:
-        status_icon = "✓" if result["success"] else "✗"
+        status_icon = Icons.SUCCESS if result["success"] else Icons.FAIL
         status_color = Colors.OKGREEN if result["success"] else Colors.FAIL
         
         print(f"{status_color}{status_icon} {result['test_name']}{Colors.ENDC}")
@@ -316,7 +414,7 @@ if __name__ == '__main__':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     
     try:
-        results = asyncio.run(run_all_tests())
+        results = asyncio.run(run_all_tests(serial='--serial' in sys.argv[1:]))
         
         # Exit with appropriate code
         failed = sum(1 for r in results if not r["success"])
@@ -18,150 +18,136 @@ from src.services.flow_client import FlowClient
 from src.services.proxy_manager import ProxyManager
 from src.services.token_manager import TokenManager
 from src.core.config import config
-from datetime import datetime
+from datetime import datetime, timezone
 
-async def diagnose():
-    """Diagnose token issues"""
-    
-    print("="*80)
-    print("Token Diagnostics Tool")
-    print("="*80)
-    print()
-    
-    # Initialize services
-    print("[1/5] Initializing database...")
-    db = Database()
-    await db.init_db()
-    
-    print("[2/5] Initializing proxy manager...")
-    proxy_manager = ProxyManager(db)
-    
-    print("[3/5] Initializing Flow client...")
-    flow_client = FlowClient(proxy_manager, db)
-    
-    print("[4/5] Initializing token manager...")
-    token_manager = TokenManager(db, flow_client)
-    
-    print("[5/5] Loading tokens from database...")
-    tokens = await db.get_all_tokens()
-    
-    print(f"\nFound {len(tokens)} token(s) in database\n")
+# Max number of tokens checked at the same time
+DIAGNOSE_CONCURRENCY = 8
+
+def _as_utc(dt: datetime) -> datetime:
+    """Treat naive datetimes from the database as UTC"""
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+async def diagnose_one(idx, token, db, flow_client, token_manager, sem):
+    """Diagnose a single token and return its report as one block of text"""
+    out = []
     
-    if not tokens:
-        print("ERROR No tokens found in database!")
-        print("\nPlease add tokens via the admin panel:")
-        print(f"  http://{config.server_host}:{config.server_port}/admin")
-        return
+    def emit(*args):
+        out.append(" ".join(map(str, args)))
     
-    # Check each token
-    for idx, token in enumerate(tokens, 1):
-        print(f"{'='*80}")
-        print(f"Token #{idx}: {token.email or 'N/A'}")
-        print(f"{'='*80}")
-        print(f"ID: {token.id}")
-        print(f"Email: {token.email or 'N/A'}")
-        print(f"Active: {token.is_active}")
-        print(f"Image Enabled: {token.image_enabled}")
-        print(f"Video Enabled: {token.video_enabled}")
-        print(f"Credits: {token.credits}")
-        print(f"User Tier: {token.user_paygate_tier}")
-        print(f"Current Project ID: {token.current_project_id or 'Not set'}")
-        print(f"Ban Reason: {token.ban_reason or 'None'}")
+    async with sem:
+        now = datetime.now(timezone.utc)
+        
+        emit(f"{'='*80}")
+        emit(f"Token #{idx}: {token.email or 'N/A'}")
+        emit(f"{'='*80}")
+        emit(f"ID: {token.id}")
+        emit(f"Email: {token.email or 'N/A'}")
+        emit(f"Active: {token.is_active}")
+        emit(f"Image Enabled: {token.image_enabled}")
+        emit(f"Video Enabled: {token.video_enabled}")
+        emit(f"Credits: {token.credits}")
+        emit(f"User Tier: {token.user_paygate_tier}")
+        emit(f"Current Project ID: {token.current_project_id or 'Not set'}")
+        emit(f"Ban Reason: {token.ban_reason or 'None'}")
         
         # Check expiry
         if token.at_expires:
-            from datetime import timezone
-            now = datetime.now(timezone.utc)
-            # Make sure at_expires is timezone-aware
-            at_expires = token.at_expires
-            if at_expires.tzinfo is None:
-                at_expires = at_expires.replace(tzinfo=timezone.utc)
+            at_expires = _as_utc(token.at_expires)
             
             if now < at_expires:
                 remaining = at_expires - now
-                print(f"AT Expires: {at_expires} (in {remaining.total_seconds()/3600:.1f} hours)")
+                emit(f"AT Expires: {at_expires} (in {remaining.total_seconds()/3600:.1f} hours)")
             else:
-                print(f"AT Expires: {at_expires} (EXPIRED)")
+                emit(f"AT Expires: {at_expires} (EXPIRED)")
         else:
-            print("AT Expires: Not set")
+            emit("AT Expires: Not set")
         
-        print()
+        emit()
+        
+        # Disabled/banned tokens can't succeed upstream, skip the network probes
+        dead = (not token.is_active) or bool(token.ban_reason) or (not token.st and not token.at)
         
         # Test ST to AT conversion
-        if token.st:
-            print("Testing ST -> AT conversion...")
+        if token.st and dead:
+            emit("Testing ST -> AT conversion... skipped (token dead)")
+        elif token.st:
+            emit("Testing ST -> AT conversion...")
             try:
                 result = await flow_client.st_to_at(token.st)
-                print(f"OK ST is valid")
-                print(f"  AT: {result['access_token'][:30]}...")
-                print(f"  Expires: {result['expires']}")
+                emit(f"OK ST is valid")
+                emit(f"  AT: {result['access_token'][:30]}...")
+                emit(f"  Expires: {result['expires']}")
                 
                 if result.get('user'):
                     user = result['user']
-                    print(f"  User Email: {user.get('email', 'N/A')}")
-                    print(f"  User Name: {user.get('name', 'N/A')}")
+                    emit(f"  User Email: {user.get('email', 'N/A')}")
+                    emit(f"  User Name: {user.get('name', 'N/A')}")
                 
             except Exception as e:
-                print(f"FAIL ST validation failed: {e}")
+                emit(f"FAIL ST validation failed: {e}")
         else:
-            print("WARNING No ST token set")
+            emit("WARNING No ST token set")
         
-        print()
+        emit()
         
         # Test AT
-        if token.at:
-            print("Testing AT (checking credits)...")
+        if token.at and dead:
+            emit("Testing AT (checking credits)... skipped (token dead)")
+        elif token.at:
+            emit("Testing AT (checking credits)...")
             try:
                 result = await flow_client.get_credits(token.at)
-                print(f"OK AT is valid")
-                print(f"  Credits: {result.get('credits', 0)}")
-                print(f"  Tier: {result.get('userPaygateTier', 'UNKNOWN')}")
+                emit(f"OK AT is valid")
+                emit(f"  Credits: {result.get('credits', 0)}")
+                emit(f"  Tier: {result.get('userPaygateTier', 'UNKNOWN')}")
             except Exception as e:
-                print(f"FAIL AT validation failed: {e}")
+                emit(f"FAIL AT validation failed: {e}")
                 
                 # Try to refresh AT from ST
                 if token.st:
-                    print("\nAttempting to refresh AT from ST...")
+                    emit("\nAttempting to refresh AT from ST...")
                     try:
-                        success = await token_manager.refresh_at(token.id)
+                        # Same entry point as the admin "refresh AT" action
+                        success = await token_manager._refresh_at(token.id)
                         if success:
-                            print("OK AT refreshed successfully")
+                            emit("OK AT refreshed successfully")
                             
                             # Re-test
                             token = await db.get_token(token.id)
                             result = await flow_client.get_credits(token.at)
-                            print(f"OK New AT is valid")
-                            print(f"  Credits: {result.get('credits', 0)}")
-                            print(f"  Tier: {result.get('userPaygateTier', 'UNKNOWN')}")
+                            emit(f"OK New AT is valid")
+                            emit(f"  Credits: {result.get('credits', 0)}")
+                            emit(f"  Tier: {result.get('userPaygateTier', 'UNKNOWN')}")
                         else:
-                            print("FAIL Failed to refresh AT")
+                            emit("FAIL Failed to refresh AT")
                     except Exception as e2:
-                        print(f"FAIL AT refresh failed: {e2}")
+                        emit(f"FAIL AT refresh failed: {e2}")
         else:
-            print("WARNING No AT token set")
+            emit("WARNING No AT token set")
         
-        print()
+        emit()
         
         # Test project
         if token.current_project_id:
-            print(f"Project ID: {token.current_project_id}")
-            print("  (Cannot test project without making API calls)")
+            emit(f"Project ID: {token.current_project_id}")
+            emit("  (Cannot test project without making API calls)")
         else:
-            print("WARNING No project ID set")
+            emit("WARNING No project ID set")
             
-            if token.at and token.st:
-                print("  Attempting to create project...")
+            if dead:
+                emit("  Project creation skipped (token dead)")
+            elif token.at and token.st:
+                emit("  Attempting to create project...")
                 try:
-                    await token_manager.ensure_project_exists(token.id)
-                    token = await db.get_token(token.id)
-                    print(f"OK Project created: {token.current_project_id}")
+                    token.current_project_id = await token_manager.ensure_project_exists(token.id)
+                    emit(f"OK Project created: {token.current_project_id}")
                 except Exception as e:
-                    print(f"FAIL Project creation failed: {e}")
+                    emit(f"FAIL Project creation failed: {e}")
         
-        print()
+        emit()
         
         # Summary
-        print("Summary:")
+        emit("Summary:")
         issues = []
         
         # Get token stats
@@ -181,12 +167,7 @@ async def diagnose():
         if not token.at:
             issues.append("No AT token")
         if token.at_expires:
-            from datetime import timezone
-            now = datetime.now(timezone.utc)
-            at_expires = token.at_expires
-            if at_expires.tzinfo is None:
-                at_expires = at_expires.replace(tzinfo=timezone.utc)
-            if now > at_expires:
+            if now > _as_utc(token.at_expires):
                 issues.append("AT expired")
         if not token.current_project_id:
             issues.append("No project ID")
@@ -194,19 +175,65 @@ async def diagnose():
             issues.append("No credits")
         
         if issues:
-            print("ERROR Issues found:")
+            emit("ERROR Issues found:")
             for issue in issues:
-                print(f"  - {issue}")
+                emit(f"  - {issue}")
         else:
-            print("OK Token appears healthy")
+            emit("OK Token appears healthy")
+        
+        emit()
         
-        print()
+    return "\n".join(out) + "\n"
+
+async def diagnose():
+    """Diagnose token issues"""
     
     print("="*80)
-    print("Diagnostic Complete")
+    print("Token Diagnostics Tool")
     print("="*80)
+    print()
+    
+    # Initialize services
+    print("[1/3] Initializing database...")
+    db = Database()
+    await db.init_db()
     
-    await db.close()
+    try:
+        print("[2/3] Loading tokens from database...")
+        tokens = await db.get_all_tokens()
+        
+        print(f"\nFound {len(tokens)} token(s) in database\n")
+        
+        if not tokens:
+            print("ERROR No tokens found in database!")
+            print("\nPlease add tokens via the admin panel:")
+            print(f"  http://{config.server_host}:{config.server_port}/admin")
+            return
+        
+        # Only build the network-facing services when there is something to check
+        print("[3/3] Initializing proxy manager, Flow client and token manager...\n")
+        proxy_manager = ProxyManager(db)
+        flow_client = FlowClient(proxy_manager, db)
+        token_manager = TokenManager(db, flow_client)
+        
+        # Check tokens concurrently, then print the reports in token order
+        sem = asyncio.Semaphore(DIAGNOSE_CONCURRENCY)
+        reports = await asyncio.gather(*(
+            diagnose_one(idx, token, db, flow_client, token_manager, sem)
+            for idx, token in enumerate(tokens, 1)
+        ), return_exceptions=True)
+        
+        for idx, (token, report) in enumerate(zip(tokens, reports), 1):
+            if isinstance(report, BaseException):
+                report = (f"{'='*80}\nToken #{idx}: {token.email or 'N/A'}\n{'='*80}\n"
+                          f"FAIL Diagnostic crashed: {type(report).__name__}: {report}\n\n")
+            sys.stdout.write(report)
+        
+        print("="*80)
+        print("Diagnostic Complete")
+        print("="*80)
+    finally:
+        await db.close()
 
 if __name__ == '__main__':
     if sys.platform == 'win32':
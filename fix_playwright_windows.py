@@ -20,15 +20,35 @@ def create_patched_browser_captcha():
 使用 Playwright 访问页面并执行 reCAPTCHA 验证
 """
 import asyncio
+import os
 import time
 import re
 import sys
 from typing import Optional, Dict
-from playwright.async_api import async_playwright, Browser, BrowserContext
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page
 
 from ..core.logger import debug_logger
 
 
+# 与 token 无关的资源（图片、字体、媒体、样式及统计/广告脚本），直接拦截
+# script / xhr 不拦截，保证 grecaptcha 能正常加载
+_BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+_BLOCKED_URL_RE = re.compile(r"(analytics|fonts|doubleclick|gtag|hotjar|segment)")
+
+
+# 代理URL格式：protocol://[username:password@]host:port
+_PROXY_RE = re.compile(r'^(socks5|http|https)://(?:([^:]+):([^@]+)@)?([^:]+):(\\d+)$')
+
+
+async def _filter_route(route):
+    """拦截无关资源，其余请求放行"""
+    request = route.request
+    if request.resource_type in _BLOCKED_RESOURCE_TYPES or _BLOCKED_URL_RE.search(request.url):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
 def parse_proxy_url(proxy_url: str) -> Optional[Dict[str, str]]:
     """解析代理URL，分离协议、主机、端口、认证信息
 
@@ -38,8 +58,7 @@ def parse_proxy_url(proxy_url: str) -> Optional[Dict[str, str]]:
     Returns:
         代理配置字典，包含server、username、password（如果有认证）
     """
-    proxy_pattern = r'^(socks5|http|https)://(?:([^:]+):([^@]+)@)?([^:]+):(\\d+)$'
-    match = re.match(proxy_pattern, proxy_url)
+    match = _PROXY_RE.match(proxy_url)
 
     if match:
         protocol, username, password, host, port = match.groups()
@@ -96,7 +115,64 @@ class BrowserCaptchaService:
     """浏览器自动化获取 reCAPTCHA token（单例模式）- Windows 兼容版本"""
 
     _instance: Optional['BrowserCaptchaService'] = None
-    _lock = asyncio.Lock()
+    _init_task: Optional[asyncio.Task] = None  # 一次性初始化任务（避免类级 Lock 绑定到旧事件循环）
+
+    # 上下文池：预创建若干上下文循环复用，使用 N 次后重建以避免内存泄漏
+    CONTEXT_POOL_SIZE = 4
+    CONTEXT_MAX_USES = 50
+    # 浏览器累计提供 N 个 token 后重启，限制 Chromium 长时间运行的内存增长
+    BROWSER_MAX_TOKENS = 500
+    # 等待空闲上下文的最长时间（秒），超时则本次获取 token 失败
+    CONTEXT_ACQUIRE_TIMEOUT = 60
+    CONTEXT_OPTIONS = {
+        'viewport': {'width': 1920, 'height': 1080},
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'locale': 'en-US',
+        'timezone_id': 'America/New_York'
+    }
+
+    # reCAPTCHA 相关 JS（常量，website_key 通过 evaluate 参数传入）
+    _CHECK_JS = "() => !!(window.grecaptcha && typeof window.grecaptcha.execute === 'function')"
+
+    _INJECT_JS = """
+        (key) => new Promise((resolve) => {
+            const script = document.createElement('script');
+            script.src = 'https://www.google.com/recaptcha/api.js?render=' + key;
+            script.async = true;
+            script.defer = true;
+            script.onload = () => {
+                console.log('reCAPTCHA script loaded');
+                resolve(true);
+            };
+            script.onerror = () => {
+                console.error('Failed to load reCAPTCHA script');
+                resolve(false);
+            };
+            document.head.appendChild(script);
+        })
+    """
+
+    _EXECUTE_JS = """
+        (key) => new Promise((resolve) => {
+            if (!window.grecaptcha || typeof window.grecaptcha.execute !== 'function') {
+                console.error('grecaptcha.execute is not available');
+                resolve(null);
+                return;
+            }
+
+            window.grecaptcha.ready(() => {
+                window.grecaptcha.execute(key, {
+                    action: 'FLOW_GENERATION'
+                }).then((token) => {
+                    console.log('Got reCAPTCHA token:', token.substring(0, 20) + '...');
+                    resolve(token);
+                }).catch((error) => {
+                    console.error('reCAPTCHA error:', error);
+                    resolve(null);
+                });
+            });
+        })
+    """
 
     def __init__(self, db=None):
         """初始化服务（始终使用无头模式）"""
@@ -107,23 +183,58 @@ class BrowserCaptchaService:
         self.website_key = "6LdsFiUsAAAAAIjVDZcuLhaHiDn5nnHVXVRQGeMV"
         self.db = db
         self._original_loop_policy = None
+        self._context_pool: Optional[asyncio.Queue] = None
+        self._context_uses: Dict[BrowserContext, int] = {}
+        self._warm_pages: Dict[BrowserContext, Page] = {}  # 已加载 grecaptcha 的常驻页面
+        self._storage_state: Optional[dict] = None  # 首次成功后的 cookies/localStorage
+        self._pool_lock = asyncio.Lock()
+        self._init_lock = asyncio.Lock()  # 启动/重启浏览器串行执行，避免并发启动多个浏览器
+        self._served = 0  # 当前浏览器已提供的 token 次数
+        # 设置 PLAYWRIGHT_CDP_URL 时连接共享的 Chromium（多 worker 共用一个浏览器进程）
+        self.cdp_url = os.environ.get('PLAYWRIGHT_CDP_URL')
+        self._context_proxy: Optional[Dict[str, str]] = None  # CDP 模式下代理按上下文设置
+
+    async def __aenter__(self) -> 'BrowserCaptchaService':
+        """用法: async with await BrowserCaptchaService.get_instance(db) as svc: ..."""
+        await self.initialize()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
 
     @classmethod
     async def get_instance(cls, db=None) -> 'BrowserCaptchaService':
-        """获取单例实例"""
+        """获取单例实例（首个调用者创建初始化任务，其余调用者等待同一任务）"""
         if cls._instance is None:
-            async with cls._lock:
-                if cls._instance is None:
-                    cls._instance = cls(db)
-                    await cls._instance.initialize()
+            if cls._init_task is None:
+                cls._init_task = asyncio.ensure_future(cls._create_instance(db))
+            task = cls._init_task
+            try:
+                await asyncio.shield(task)
+            except Exception:
+                # 初始化失败，允许下次调用重试（只清除自己等待的任务，不覆盖已发起的重试）
+                if cls._init_task is task:
+                    cls._init_task = None
+                raise
         return cls._instance
 
+    @classmethod
+    async def _create_instance(cls, db=None):
+        """创建并初始化单例"""
+        instance = cls(db)
+        await instance.initialize()
+        cls._instance = instance
+
     def _setup_windows_event_loop(self):
-        """为 Windows 设置正确的事件循环策略"""
+        """为 Windows 设置正确的事件循环策略（已是 Proactor 时不切换）"""
         if sys.platform == 'win32':
             try:
+                current_policy = asyncio.get_event_loop_policy()
+                if isinstance(current_policy, asyncio.WindowsProactorEventLoopPolicy):
+                    return
+
                 # 保存当前策略
-                self._original_loop_policy = asyncio.get_event_loop_policy()
+                self._original_loop_policy = current_policy
                 
                 # 使用 ProactorEventLoop（支持子进程）
                 asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
@@ -144,6 +255,22 @@ class BrowserCaptchaService:
         """初始化浏览器（启动一次）"""
         if self._initialized:
             return
+        async with self._init_lock:
+            await self._start()
+
+    async def _restart(self):
+        """重启浏览器（持有初始化锁，等待中的 initialize 调用直接复用新浏览器）"""
+        async with self._init_lock:
+            await self.close()
+            await self._start()
+
+    async def _start(self):
+        """启动浏览器并创建上下文池（调用方需持有 _init_lock）"""
+        if self._initialized:
+            return
+        if self.browser is not None or self.playwright is not None:
+            # 上次运行残留（回收上下文失败后被标记为未初始化），先关闭旧浏览器
+            await self.close()
 
         try:
             # Windows: 切换到 ProactorEventLoop
@@ -180,15 +307,95 @@ class BrowserCaptchaService:
                 else:
                     debug_logger.log_warning(f"[BrowserCaptcha] 代理URL格式错误: {proxy_url}")
 
-            self.browser = await self.playwright.chromium.launch(**launch_options)
+            if self.cdp_url:
+                # 共享浏览器由外部启动（--remote-debugging-port），代理改为按上下文设置
+                self._context_proxy = launch_options.get('proxy')
+                self.browser = await self.playwright.chromium.connect_over_cdp(self.cdp_url)
+                debug_logger.log_info(f"[BrowserCaptcha] 已连接共享浏览器: {self.cdp_url}")
+            else:
+                self.browser = await self.playwright.chromium.launch(**launch_options)
+
+            # 预创建上下文池（旧浏览器遗留的上下文不再计入）
+            self._context_uses = {}
+            self._warm_pages = {}
+            self._context_pool = asyncio.Queue()
+            for _ in range(self.CONTEXT_POOL_SIZE):
+                self._context_pool.put_nowait(await self._new_context())
+
+            self._served = 0
             self._initialized = True
             debug_logger.log_info(f"[BrowserCaptcha] ✅ 浏览器已启动 (headless={self.headless}, proxy={proxy_url or 'None'})")
         except Exception as e:
             debug_logger.log_error(f"[BrowserCaptcha] ❌ 浏览器启动失败: {str(e)}")
-            # 恢复事件循环
-            self._restore_event_loop()
+            # 清理已启动的部分（浏览器/Playwright），并恢复事件循环
+            await self.close()
             raise
 
+    async def _new_context(self) -> BrowserContext:
+        """创建新的浏览器上下文"""
+        options = dict(self.CONTEXT_OPTIONS)
+        if self._storage_state:
+            options['storage_state'] = self._storage_state
+        if self._context_proxy:
+            options['proxy'] = self._context_proxy
+        context = await self.browser.new_context(**options)
+        # 在上下文级别设置，池中的上下文只需设置一次
+        await context.route("**/*", _filter_route)
+        self._context_uses[context] = 0
+        return context
+
+    async def _close_context(self, context: BrowserContext):
+        """关闭上下文"""
+        self._context_uses.pop(context, None)
+        self._warm_pages.pop(context, None)
+        try:
+            await context.close()
+        except Exception as e:
+            debug_logger.log_warning(f"[BrowserCaptcha] 关闭上下文失败: {str(e)}")
+
+    async def _acquire_context(self) -> BrowserContext:
+        """从池中取出上下文（达到重启阈值且无进行中的请求，或上下文池已损坏时先重启浏览器）"""
+        async with self._pool_lock:
+            if not self._initialized:
+                debug_logger.log_info("[BrowserCaptcha] 上下文池不可用，重启浏览器")
+                await self._restart()
+            elif (self._served >= self.BROWSER_MAX_TOKENS
+                    and self._context_pool.qsize() == self.CONTEXT_POOL_SIZE):
+                debug_logger.log_info(f"[BrowserCaptcha] 已提供 {self._served} 个 token，重启浏览器")
+                await self._restart()
+            return await asyncio.wait_for(self._context_pool.get(), timeout=self.CONTEXT_ACQUIRE_TIMEOUT)
+
+    async def _release_context(self, context: BrowserContext):
+        """归还上下文到池中（达到使用上限则重建）"""
+        self._served += 1
+        if (not self._initialized or self._context_pool is None
+                or context not in self._context_uses):
+            # 服务已关闭/重启，或上下文属于旧浏览器
+            await self._close_context(context)
+            return
+        uses = self._context_uses[context] + 1
+
+        try:
+            if uses >= self.CONTEXT_MAX_USES:
+                await self._close_context(context)
+                context = await self._new_context()
+            else:
+                self._context_uses[context] = uses
+                # 重置为已缓存的状态
+                await context.clear_cookies()
+                if self._storage_state and self._storage_state.get('cookies'):
+                    await context.add_cookies(self._storage_state['cookies'])
+            self._context_pool.put_nowait(context)
+        except Exception as e:
+            debug_logger.log_warning(f"[BrowserCaptcha] 回收上下文失败，重新创建: {str(e)}")
+            await self._close_context(context)
+            try:
+                self._context_pool.put_nowait(await self._new_context())
+            except Exception as e:
+                # 浏览器可能已失效：标记为未初始化，下次取上下文时重启并补满上下文池
+                debug_logger.log_error(f"[BrowserCaptcha] 重新创建上下文失败，将重启浏览器: {str(e)}")
+                self._initialized = False
+
     async def get_token(self, project_id: str) -> Optional[str]:
         """获取 reCAPTCHA token
 
@@ -203,93 +410,37 @@ class BrowserCaptchaService:
 
         start_time = time.time()
         context = None
+        page = None
+        keep_page = False
 
         try:
-            # 创建新的上下文
-            context = await self.browser.new_context(
-                viewport={'width': 1920, 'height': 1080},
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                locale='en-US',
-                timezone_id='America/New_York'
-            )
-            page = await context.new_page()
-
-            website_url = f"https://labs.google/fx/tools/flow/project/{project_id}"
-
-            debug_logger.log_info(f"[BrowserCaptcha] 访问页面: {website_url}")
-
-            # 访问页面
-            try:
-                await page.goto(website_url, wait_until="domcontentloaded", timeout=30000)
-            except Exception as e:
-                debug_logger.log_warning(f"[BrowserCaptcha] 页面加载超时或失败: {str(e)}")
-
-            # 检查并注入 reCAPTCHA v3 脚本
-            debug_logger.log_info("[BrowserCaptcha] 检查并加载 reCAPTCHA v3 脚本...")
-            script_loaded = await page.evaluate("""
-                () => {
-                    if (window.grecaptcha && typeof window.grecaptcha.execute === 'function') {
-                        return true;
-                    }
-                    return false;
-                }
-            """)
-
-            if not script_loaded:
-                # 注入脚本
-                debug_logger.log_info("[BrowserCaptcha] 注入 reCAPTCHA v3 脚本...")
-                await page.evaluate(f"""
-                    () => {{
-                        return new Promise((resolve) => {{
-                            const script = document.createElement('script');
-                            script.src = 'https://www.google.com/recaptcha/api.js?render={self.website_key}';
-                            script.async = true;
-                            script.defer = true;
-                            script.onload = () => {{
-                                console.log('reCAPTCHA script loaded');
-                                resolve(true);
-                            }};
-                            script.onerror = () => {{
-                                console.error('Failed to load reCAPTCHA script');
-                                resolve(false);
-                            }};
-                            document.head.appendChild(script);
-                        }});
-                    }}
-                """)
-
-                # 等待脚本加载和初始化
-                await asyncio.sleep(3)
+            # 从池中取出上下文
+            context = await self._acquire_context()
+
+            warm_page = self._warm_pages.get(context)
+            if warm_page is not None and not warm_page.is_closed():
+                # 预热页面上 grecaptcha 已加载，直接执行
+                page = warm_page
+                debug_logger.log_info("[BrowserCaptcha] 使用预热页面执行 reCAPTCHA...")
+            else:
+                page = await self._load_captcha_page(context, project_id)
 
             # 执行 reCAPTCHA 获取 token
             debug_logger.log_info("[BrowserCaptcha] 执行 reCAPTCHA...")
-            token = await page.evaluate(f"""
-                () => {{
-                    return new Promise((resolve) => {{
-                        if (!window.grecaptcha || typeof window.grecaptcha.execute !== 'function') {{
-                            console.error('grecaptcha.execute is not available');
-                            resolve(null);
-                            return;
-                        }}
-                        
-                        window.grecaptcha.ready(() => {{
-                            window.grecaptcha.execute('{self.website_key}', {{
-                                action: 'FLOW_GENERATION'
-                            }}).then((token) => {{
-                                console.log('Got reCAPTCHA token:', token.substring(0, 20) + '...');
-                                resolve(token);
-                            }}).catch((error) => {{
-                                console.error('reCAPTCHA error:', error);
-                                resolve(null);
-                            }});
-                        }});
-                    }});
-                }}
-            """)
+            token = await page.evaluate(self._EXECUTE_JS, self.website_key)
 
             duration = time.time() - start_time
 
             if token:
+                # 缓存首次成功的会话状态，供后续新建的上下文复用
+                if self._storage_state is None:
+                    try:
+                        self._storage_state = await context.storage_state()
+                    except Exception as e:
+                        debug_logger.log_warning(f"[BrowserCaptcha] 保存会话状态失败: {str(e)}")
+                # 保留成功的页面作为该上下文的预热页面
+                self._warm_pages[context] = page
+                keep_page = True
                 debug_logger.log_info(f"[BrowserCaptcha] ✅ Token获取成功 (耗时: {duration:.2f}s, token前20字符: {token[:20]}...)")
                 return token
             else:
@@ -301,15 +452,56 @@ class BrowserCaptchaService:
             debug_logger.log_error(f"[BrowserCaptcha] ❌ 获取Token时发生异常 (耗时: {duration:.2f}s): {str(e)}")
             return None
         finally:
-            # 清理上下文
-            if context:
+            # 失败的页面（包括失效的预热页面）关闭，然后归还上下文
+            if page and not keep_page:
+                if self._warm_pages.get(context) is page:
+                    del self._warm_pages[context]
                 try:
-                    await context.close()
+                    await page.close()
                 except Exception as e:
-                    debug_logger.log_warning(f"[BrowserCaptcha] 关闭上下文失败: {str(e)}")
+                    debug_logger.log_warning(f"[BrowserCaptcha] 关闭页面失败: {str(e)}")
+            if context:
+                await self._release_context(context)
+
+    async def _load_captcha_page(self, context: BrowserContext, project_id: str) -> Page:
+        """打开 Flow 页面并确保 reCAPTCHA 脚本已加载（token 需与站点同源）"""
+        page = await context.new_page()
+
+        website_url = f"https://labs.google/fx/tools/flow/project/{project_id}"
+
+        debug_logger.log_info(f"[BrowserCaptcha] 访问页面: {website_url}")
+
+        # 访问页面
+        try:
+            await page.goto(website_url, wait_until="domcontentloaded", timeout=30000)
+        except Exception as e:
+            debug_logger.log_warning(f"[BrowserCaptcha] 页面加载超时或失败: {str(e)}")
+
+        # 检查并注入 reCAPTCHA v3 脚本
+        debug_logger.log_info("[BrowserCaptcha] 检查并加载 reCAPTCHA v3 脚本...")
+        script_loaded = await page.evaluate(self._CHECK_JS)
+
+        if not script_loaded:
+            # 注入脚本
+            debug_logger.log_info("[BrowserCaptcha] 注入 reCAPTCHA v3 脚本...")
+            await page.evaluate(self._INJECT_JS, self.website_key)
+
+            # 等待 grecaptcha 可用（超时后由执行步骤处理失败情况）
+            try:
+                await page.wait_for_function(self._CHECK_JS, timeout=8000)
+            except Exception as e:
+                debug_logger.log_warning(f"[BrowserCaptcha] 等待 reCAPTCHA 脚本超时: {str(e)}")
+
+        return page
 
     async def close(self):
         """关闭浏览器"""
+        # 先关闭池中的上下文
+        if self._context_pool is not None:
+            while not self._context_pool.empty():
+                await self._close_context(self._context_pool.get_nowait())
+            self._context_pool = None
+
         if self.browser:
             try:
                 await self.browser.close()
@@ -331,17 +523,6 @@ class BrowserCaptchaService:
         
         # 恢复事件循环
         self._restore_event_loop()
-
-    def __del__(self):
-        """析构函数"""
-        if self._initialized:
-            try:
-                # 尝试清理资源
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    loop.create_task(self.close())
-            except:
-                pass
 '''
     
     return patch_code
@@ -363,26 +544,27 @@ def apply_patch():
         print(f"ERROR: {original_file} not found!")
         return False
     
-    # Create backup
-    print(f"\n1. Creating backup: {backup_file.name}")
-    shutil.copy2(original_file, backup_file)
-    print("   OK: Backup created")
-    
-    # Read original to preserve the rest of the file
-    with open(original_file, 'r', encoding='utf-8') as f:
-        original_content = f.read()
+    # Read original once (reused for the patched check and the backup)
+    original_content = original_file.read_bytes()
     
-    # Check if already patched
-    if 'WindowsProactorEventLoopPolicy' in original_content:
+    # Check if already patched (before touching the backup)
+    if b'WindowsProactorEventLoopPolicy' in original_content:
         print("\n   Already patched! No changes needed.")
         return True
     
-    # Write patched version
+    # Create backup
+    print(f"\n1. Creating backup: {backup_file.name}")
+    backup_file.write_bytes(original_content)
+    shutil.copystat(original_file, backup_file)
+    print("   OK: Backup created")
+    
+    # Write patched version to a temp file, then swap it in atomically
     print("\n2. Applying patch...")
     patched_content = create_patched_browser_captcha()
     
-    with open(original_file, 'w', encoding='utf-8') as f:
-        f.write(patched_content)
+    tmp_file = original_file.with_suffix(original_file.suffix + '.tmp')
+    tmp_file.write_text(patched_content, encoding='utf-8')
+    os.replace(tmp_file, original_file)
     
     print("   OK: Patch applied")
     
@@ -393,6 +575,9 @@ def apply_patch():
     print("     * Added WindowsProactorEventLoopPolicy support")
     print("     * Added event loop switching on Windows")
     print("     * Added proper cleanup/restore")
+    print("     * Reuse pooled browser contexts across token requests")
+    print("     * Optional shared browser: set PLAYWRIGHT_CDP_URL (e.g. http://127.0.0.1:9222)")
+    print("       to connect to a Chromium you start yourself with --remote-debugging-port")
     
     print("\n" + "=" * 60)
     print("SUCCESS: Patch applied successfully!")
@@ -18,6 +18,10 @@ class Database:
             db_path = str(data_dir / "flow.db")
         self.db_path = db_path
 
+    async def close(self):
+        """Release database resources (connections are opened per operation, so nothing is held)"""
+        pass
+
     def db_exists(self) -> bool:
         """Check if database file exists"""
         return Path(self.db_path).exists()
@@ -666,6 +670,23 @@ class Database:
             rows = await cursor.fetchall()
             return [Token(**dict(row)) for row in rows]
 
+    async def get_first_active_token_with_valid_at(self, now: datetime) -> Optional[Token]:
+        """Get the active token whose AT expires last, if it is still valid at `now`"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            # datetime() normalizes stored values (naive or with +00:00) to UTC for comparison
+            cursor = await db.execute("""
+                SELECT * FROM tokens
+                WHERE is_active = 1 AND at IS NOT NULL AND at != ''
+                  AND datetime(at_expires) > datetime(?)
+                ORDER BY datetime(at_expires) DESC
+                LIMIT 1
+            """, (now.isoformat(),))
+            row = await cursor.fetchone()
+            if row:
+                return Token(**dict(row))
+            return None
+
     async def update_token(self, token_id: int, **kwargs):
         """Update token fields"""
         async with aiosqlite.connect(self.db_path) as db:
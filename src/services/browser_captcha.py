@@ -177,11 +177,14 @@ LABS_URL = "https://labs.google/fx/tools/flow"
 # ==========================================
 # 代理解析工具函数
 # ==========================================
+_PROXY_SCHEME_RE = re.compile(r'^(http|https|socks5)://')
+_PROXY_RE = re.compile(r'^(socks5|http|https)://(?:([^:]+):([^@]+)@)?([^:]+):(\d+)$')
+
 def parse_proxy_url(proxy_url: str) -> Optional[Dict[str, str]]:
     """解析代理URL"""
     if not proxy_url: return None
-    if not re.match(r'^(http|https|socks5)://', proxy_url): proxy_url = f"http://{proxy_url}"
-    match = re.match(r'^(socks5|http|https)://(?:([^:]+):([^@]+)@)?([^:]+):(\d+)$', proxy_url)
+    if not _PROXY_SCHEME_RE.match(proxy_url): proxy_url = f"http://{proxy_url}"
+    match = _PROXY_RE.match(proxy_url)
     if match:
         protocol, username, password, host, port = match.groups()
         proxy_config = {'server': f'{protocol}://{host}:{port}'}
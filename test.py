@@ -15,19 +15,74 @@ import re
 import aiohttp
 import asyncio
 import io
+from typing import Optional
+
+# orjson is optional; it parses SSE payloads (bytes) several times faster than json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
 
 # Fix Windows console encoding
 if sys.platform == "win32":
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+elif hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(errors='replace')
+
+# Flush streamed progress text every N deltas (or on newline) instead of per delta
+FLUSH_EVERY = 16
 
 # Configuration
 BASE_URL = os.getenv('FLOW2API_URL', 'http://localhost:18282')
 API_ENDPOINT = f"{BASE_URL}/v1/chat/completions"
 API_KEY = os.getenv('FLOW2API_API_KEY', 'PApiKey1800KOOOO')
 
-async def quick_generate(prompt: str, model: str = 'gemini-2.5-flash-image-landscape'):
-    """Quick image generation test"""
+# Markdown image pattern, compiled once (negated classes avoid backtracking)
+_IMG_RE = re.compile(r'!\[[^\]]*\]\(([^)]+)\)')
+
+async def iter_sse_data(content: aiohttp.StreamReader, chunk_size: int = 64 * 1024):
+    """Yield the raw data payload of each SSE event (events end with a blank line)
+    
+    Events are split from a local buffer so a separator spanning two network
+    chunks is still found.
+    """
+    buffer = bytearray()
+    
+    def parse(event: bytes):
+        data = [line[6:] for line in event.split(b'\n') if line.startswith(b'data: ')]
+        return b'\n'.join(data).strip() if data else None
+    
+    async for chunk in content.iter_chunked(chunk_size):
+        buffer += chunk
+        start = 0
+        while (sep := buffer.find(b'\n\n', start)) != -1:
+            data = parse(bytes(buffer[start:sep]))
+            if data is not None:
+                yield data
+            start = sep + 2
+        if start:
+            del buffer[:start]
+    if buffer:
+        data = parse(bytes(buffer))
+        if data is not None:
+            yield data
+
+def create_session() -> aiohttp.ClientSession:
+    """Create a client session with keep-alive and DNS caching"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+
+async def quick_generate(prompt: str, model: str = 'gemini-2.5-flash-image-landscape',
+                         session: Optional[aiohttp.ClientSession] = None):
+    """Quick image generation test
+    
+    Pass a shared session to reuse connections across several calls; otherwise
+    one is created (and closed) for this call. The image download reuses it too.
+    """
     print(f"Generating image with prompt: '{prompt}'")
     print(f"Model: {model}")
     print(f"Endpoint: {API_ENDPOINT}\n")
@@ -44,67 +99,73 @@ async def quick_generate(prompt: str, model: str = 'gemini-2.5-flash-image-lands
     }
     
     image_url = None
+    own_session = session is None
+    if own_session:
+        session = create_session()
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_ENDPOINT, json=payload, headers=headers, timeout=300) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    print(f"Error {response.status}: {error_text}")
-                    return None
+        async with session.post(API_ENDPOINT, json=payload, headers=headers, timeout=300) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                print(f"Error {response.status}: {error_text}")
+                return None
+            
+            print("Streaming response...\n")
+            
+            pending = 0
+            async for data_bytes in iter_sse_data(response.content):
+                if data_bytes == b'[DONE]':
+                    break
                 
-                print("Streaming response...\n")
-                
-                async for line in response.content:
-                    line_str = line.decode('utf-8').strip()
-                    if not line_str or not line_str.startswith('data: '):
-                        continue
+                try:
+                    chunk = json_loads(data_bytes)
+                    delta = chunk.get("choices", [{}])[0].get("delta", {})
                     
-                    data_str = line_str[6:]
-                    if data_str == '[DONE]':
-                        break
+                    if "reasoning_content" in delta:
+                        content = delta['reasoning_content']
+                        sys.stdout.write(content)
+                        pending += 1
+                        if pending >= FLUSH_EVERY or '\n' in content:
+                            sys.stdout.flush()
+                            pending = 0
                     
-                    try:
-                        chunk = json.loads(data_str)
-                        delta = chunk.get("choices", [{}])[0].get("delta", {})
-                        
-                        if "reasoning_content" in delta:
-                            content = delta['reasoning_content']
-                            try:
-                                print(content, end="", flush=True)
-                            except UnicodeEncodeError:
-                                # Fallback for encoding issues
-                                print(content.encode('ascii', 'replace').decode('ascii'), end="", flush=True)
-                        
-                        if "content" in delta:
-                            content_text = delta["content"]
-                            img_match = re.search(r'!\[.*?\]\((.*?)\)', content_text)
-                            if img_match:
-                                image_url = img_match.group(1)
-                                print(f"\n\nImage URL: {image_url}")
-                    except json.JSONDecodeError:
-                        continue
+                    if "content" in delta:
+                        content_text = delta["content"]
+                        img_match = _IMG_RE.search(content_text)
+                        if img_match:
+                            image_url = img_match.group(1)
+                            print(f"\n\nImage URL: {image_url}")
+                except json.JSONDecodeError:
+                    continue
+            
+            sys.stdout.flush()
+            
+            if image_url:
+                print("\nDownloading image...")
+                async with session.get(image_url) as img_response:
+                    if img_response.status == 200:
+                        # Stream to disk instead of holding the whole image in memory
+                        filename = "output.jpg"
+                        total = 0
+                        with open(filename, 'wb') as f:
+                            async for chunk in img_response.content.iter_chunked(65536):
+                                f.write(chunk)
+                                total += len(chunk)
+                        print(f"Image saved to: {filename} ({total} bytes)")
+                        return filename
+                    else:
+                        print(f"Download failed: {img_response.status}")
+                        return None
+            else:
+                print("\nNo image URL found")
+                return None
                 
-                if image_url:
-                    print("\nDownloading image...")
-                    async with session.get(image_url) as img_response:
-                        if img_response.status == 200:
-                            image_bytes = await img_response.read()
-                            filename = "output.jpg"
-                            with open(filename, 'wb') as f:
-                                f.write(image_bytes)
-                            print(f"Image saved to: {filename} ({len(image_bytes)} bytes)")
-                            return image_bytes
-                        else:
-                            print(f"Download failed: {img_response.status}")
-                            return None
-                else:
-                    print("\nNo image URL found")
-                    return None
-                    
     except Exception as e:
         print(f"\nError: {e}")
         return None
+    finally:
+        if own_session:
+            await session.close()
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
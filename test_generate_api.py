@@ -4,13 +4,24 @@ Tests the Flow API generate_image function directly with detailed logging
 
 Usage:
     python test_generate_api.py
+
+Environment:
+    Set FLOW2API_DEBUG_VERBOSE=1 to list the AT state of every active token
 """
 
 import asyncio
 import sys
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timezone
+
+# orjson is optional; used for faster pretty-printing of large responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+VERBOSE = os.getenv('FLOW2API_DEBUG_VERBOSE') == '1'
 
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
@@ -31,7 +42,10 @@ def print_json(data, title=""):
     """Print JSON data in formatted way"""
     if title:
         print(f"\n{title}:")
-    print(json.dumps(data, indent=2, ensure_ascii=False))
+    if orjson:
+        print(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+    else:
+        print(json.dumps(data, indent=2, ensure_ascii=False))
 
 async def test_generate_image_api():
     """Test the generate_image API directly"""
@@ -53,41 +67,51 @@ async def test_generate_image_api():
     token_manager = TokenManager(db, flow_client)
     
     print("[5/6] Loading tokens from database...")
-    tokens = await db.get_all_tokens()
+    # Time doesn't meaningfully advance during selection, read the clock once
+    now = datetime.now(timezone.utc)
+    # Both reads only need init_db(), so run them together
+    tokens, active_token = await asyncio.gather(
+        db.get_all_tokens(),
+        db.get_first_active_token_with_valid_at(now)
+    )
     
     if not tokens:
         print("\nERROR: No tokens found in database!")
         return
     
+    # Expiry times are stored as naive UTC; make them aware once, here
+    for token in (*tokens, active_token):
+        if token and token.at_expires and token.at_expires.tzinfo is None:
+            token.at_expires = token.at_expires.replace(tzinfo=timezone.utc)
+    
     print(f"Found {len(tokens)} token(s)")
     
-    # Find an active token with valid AT
-    active_token = None
-    for token in tokens:
-        if token.is_active and token.at:
-            print(f"\nUsing Token: {token.email} (ID: {token.id})")
-            print(f"  Active: {token.is_active}")
-            print(f"  Credits: {token.credits}")
-            print(f"  Tier: {token.user_paygate_tier}")
-            print(f"  Project ID: {token.current_project_id}")
-            
-            # Check if AT is valid
-            from datetime import timezone
-            if token.at_expires:
-                now = datetime.now(timezone.utc)
-                at_expires = token.at_expires
-                if at_expires.tzinfo is None:
-                    at_expires = at_expires.replace(tzinfo=timezone.utc)
+    # Optionally show the AT state of every active token
+    if VERBOSE:
+        for token in tokens:
+            if token.is_active and token.at:
+                print(f"\nToken: {token.email} (ID: {token.id})")
                 
-                if now < at_expires:
-                    remaining = at_expires - now
-                    print(f"  AT expires in: {remaining.total_seconds()/3600:.1f} hours")
-                    active_token = token
-                    break
+                # Check if AT is valid
+                if token.at_expires:
+                    if now < token.at_expires:
+                        remaining = token.at_expires - now
+                        print(f"  AT expires in: {remaining.total_seconds()/3600:.1f} hours")
+                    else:
+                        print(f"  AT EXPIRED!")
                 else:
-                    print(f"  AT EXPIRED!")
-            else:
-                print(f"  AT expiry not set")
+                    print(f"  AT expiry not set")
+    
+    # Active token with valid AT (filtered in the database)
+    if active_token:
+        print(f"\nUsing Token: {active_token.email} (ID: {active_token.id})")
+        print(f"  Active: {active_token.is_active}")
+        print(f"  Credits: {active_token.credits}")
+        print(f"  Tier: {active_token.user_paygate_tier}")
+        print(f"  Project ID: {active_token.current_project_id}")
+        
+        remaining = active_token.at_expires - now
+        print(f"  AT expires in: {remaining.total_seconds()/3600:.1f} hours")
     
     if not active_token:
         print("\nERROR: No active token with valid AT found!")
@@ -162,21 +186,12 @@ async def test_generate_image_api():
         }
     ]
     
-    for idx, test_case in enumerate(test_cases, 1):
-        print_section(f"Test Case #{idx}: {test_case['name']}")
-        
-        print("Request Parameters:")
-        print(f"  Prompt: {test_case['prompt']}")
-        print(f"  Model: {test_case['model_name']}")
-        print(f"  Aspect Ratio: {test_case['aspect_ratio']}")
-        print(f"  Image Inputs: {len(test_case['image_inputs'])} images")
-        print(f"  Project ID: {project_id}")
-        print(f"  AT Token: {active_token.at[:30]}...")
-        
-        try:
-            print("\nCalling flow_client.generate_image()...")
+    # Test cases are independent upstream calls: issue them concurrently
+    sem = asyncio.Semaphore(4)
+    
+    async def run_case(test_case):
+        async with sem:
             start_time = asyncio.get_event_loop().time()
-            
             result = await flow_client.generate_image(
                 at=active_token.at,
                 project_id=project_id,
@@ -185,52 +200,25 @@ async def test_generate_image_api():
                 aspect_ratio=test_case['aspect_ratio'],
                 image_inputs=test_case['image_inputs']
             )
-            
             end_time = asyncio.get_event_loop().time()
-            duration_ms = int((end_time - start_time) * 1000)
-            
-            print(f"\nOK: API call succeeded in {duration_ms}ms")
-            
-            # Print full response
-            print_section("Full API Response")
-            print_json(result, "Response JSON")
-            
-            # Extract and display image URL
-            print_section("Extracted Data")
-            
-            media = result.get("media", [])
-            if media:
-                print(f"Number of media items: {len(media)}")
-                
-                for media_idx, media_item in enumerate(media, 1):
-                    print(f"\nMedia #{media_idx}:")
-                    
-                    if "image" in media_item:
-                        image_data = media_item["image"]
-                        
-                        if "generatedImage" in image_data:
-                            gen_image = image_data["generatedImage"]
-                            
-                            print(f"  Image URL: {gen_image.get('fifeUrl', 'N/A')}")
-                            print(f"  Image ID: {gen_image.get('name', 'N/A')}")
-                            print(f"  Width: {gen_image.get('width', 'N/A')}")
-                            print(f"  Height: {gen_image.get('height', 'N/A')}")
-                            
-                            if 'metadata' in gen_image:
-                                metadata = gen_image['metadata']
-                                print(f"  Metadata: {json.dumps(metadata, indent=4)}")
-                
-                print("\nOK: Image generated successfully!")
-                
-            else:
-                print("WARNING: No media items in response")
-                
-            # Check remaining credits
-            remaining = result.get("remainingCredits")
-            if remaining is not None:
-                print(f"\nRemaining Credits: {remaining}")
-            
-        except Exception as e:
+            return result, int((end_time - start_time) * 1000)
+    
+    print(f"\nCalling flow_client.generate_image() for {len(test_cases)} test cases concurrently...")
+    outcomes = await asyncio.gather(*(run_case(tc) for tc in test_cases), return_exceptions=True)
+    
+    for idx, (test_case, outcome) in enumerate(zip(test_cases, outcomes), 1):
+        print_section(f"Test Case #{idx}: {test_case['name']}")
+        
+        print("Request Parameters:")
+        print(f"  Prompt: {test_case['prompt']}")
+        print(f"  Model: {test_case['model_name']}")
+        print(f"  Aspect Ratio: {test_case['aspect_ratio']}")
+        print(f"  Image Inputs: {len(test_case['image_inputs'])} images")
+        print(f"  Project ID: {project_id}")
+        print(f"  AT Token: {active_token.at[:30]}...")
+        
+        if isinstance(outcome, Exception):
+            e = outcome
             print(f"\nFAIL: API call failed")
             print(f"Error Type: {type(e).__name__}")
             print(f"Error Message: {str(e)}")
@@ -238,18 +226,56 @@ async def test_generate_image_api():
             # Print detailed error info
             import traceback
             print("\nFull Traceback:")
-            print(traceback.format_exc())
+            print("".join(traceback.format_exception(type(e), e, e.__traceback__)))
             
             # Try to extract response details if available
             if hasattr(e, '__dict__'):
                 print("\nError Details:")
                 for key, value in e.__dict__.items():
                     print(f"  {key}: {value}")
+            continue
+        
+        result, duration_ms = outcome
+        print(f"\nOK: API call succeeded in {duration_ms}ms")
         
-        # Pause between tests
-        if idx < len(test_cases):
-            print("\nWaiting 3 seconds before next test...")
-            await asyncio.sleep(3)
+        # Print full response
+        print_section("Full API Response")
+        print_json(result, "Response JSON")
+        
+        # Extract and display image URL
+        print_section("Extracted Data")
+        
+        media = result.get("media", [])
+        if media:
+            print(f"Number of media items: {len(media)}")
+            
+            for media_idx, media_item in enumerate(media, 1):
+                print(f"\nMedia #{media_idx}:")
+                
+                if "image" in media_item:
+                    image_data = media_item["image"]
+                    
+                    if "generatedImage" in image_data:
+                        gen_image = image_data["generatedImage"]
+                        
+                        print(f"  Image URL: {gen_image.get('fifeUrl', 'N/A')}")
+                        print(f"  Image ID: {gen_image.get('name', 'N/A')}")
+                        print(f"  Width: {gen_image.get('width', 'N/A')}")
+                        print(f"  Height: {gen_image.get('height', 'N/A')}")
+                        
+                        if 'metadata' in gen_image:
+                            metadata = gen_image['metadata']
+                            print(f"  Metadata: {json.dumps(metadata, indent=4)}")
+            
+            print("\nOK: Image generated successfully!")
+            
+        else:
+            print("WARNING: No media items in response")
+            
+        # Check remaining credits
+        remaining = result.get("remainingCredits")
+        if remaining is not None:
+            print(f"\nRemaining Credits: {remaining}")
     
     print_section("Test Complete")
 